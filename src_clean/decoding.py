@@ -100,7 +100,7 @@ def decode_sample(transducer,
                                  trg_eos=EOS_IDX)
     transducer.eval()
     src_mask = dummy_mask(src_sentence)
-    enc_hs = transducer.encode(src_sentence)
+    enc_hs = transducer.encode(src_sentence, src_mask)
 
     output, attns = [], []
     hidden = transducer.dec_rnn.get_init_hx(1)
@@ -125,7 +125,7 @@ def decode_sample_hmm(transducer,
                       trg_eos=EOS_IDX):
     transducer.eval()
     src_mask = dummy_mask(src_sentence)
-    enc_hs = transducer.encode(src_sentence)
+    enc_hs = transducer.encode(src_sentence, src_mask)
     T = src_mask.shape[0]
 
     output, attns = [], []
@@ -188,7 +188,7 @@ def decode_greedy(transducer,
                                          trg_eos=EOS_IDX)
     transducer.eval()
     src_mask = dummy_mask(src_sentence)
-    enc_hs = transducer.encode(src_sentence)
+    enc_hs = transducer.encode(src_sentence, src_mask)
 
     output, attns = [], []
     hidden = transducer.dec_rnn.get_init_hx(1)
@@ -251,7 +251,7 @@ def decode_greedy_hmm(transducer,
                       trg_eos=EOS_IDX):
     transducer.eval()
     src_mask = dummy_mask(src_sentence)
-    enc_hs = transducer.encode(src_sentence)
+    enc_hs = transducer.encode(src_sentence, src_mask)
     T = src_mask.shape[0]
 
     output, attns = [], []
@@ -361,7 +361,7 @@ def decode_beam_search(transducer,
 
     transducer.eval()
     src_mask = dummy_mask(src_sentence)
-    enc_hs = transducer.encode(src_sentence)
+    enc_hs = transducer.encode(src_sentence, src_mask)
 
     hidden = transducer.dec_rnn.get_init_hx(1)
     input_ = torch.tensor([trg_bos], device=DEVICE)
@@ -491,8 +491,7 @@ def decode_beam_hmm(transducer,
 
     transducer.eval()
     src_mask = dummy_mask(src_sentence)
-    enc_hs = transducer.encode(src_sentence)
-    T = src_mask.shape[0]
+    enc_hs = transducer.encode(src_sentence, src_mask)
 
     output, attns = [], []
     hidden = transducer.dec_rnn.get_init_hx(1)
@@ -531,14 +530,16 @@ def decode_beam_hmm(transducer,
             log_wordprob = forward + emiss.transpose(1, 2)
             log_wordprob = log_wordprob.logsumexp(dim=-1)
             topk_word = torch.topk(log_wordprob, nb_beam, dim=-1)[1]
-            for word in topk_word.view(nb_beam, 1):
+            topk_word = topk_word.view(nb_beam, 1)
+            # emission of every candidate word in one gather: nb_beam x 1 x T
+            topk_emiss = emiss[0, :, topk_word.view(-1)].t().unsqueeze(1)
+            next_forwards = forward + topk_emiss
+            log_probs = torch.logsumexp(next_forwards, dim=-1).view(-1)
+            candidates = zip(topk_word, next_forwards.split(1),
+                             log_probs.tolist())
+            for word, next_forward, log_prob in candidates:
                 next_input = transducer.dropout(transducer.trg_embed(word))
                 next_output = str(word.item())
-                word_idx = word.view(-1, 1).expand(1, T).unsqueeze(-1)
-                word_emiss = torch.gather(emiss, -1, word_idx).view(1, 1, T)
-                next_forward = forward + word_emiss
-
-                log_prob = torch.logsumexp(next_forward, dim=-1).item()
 
                 if word == trg_eos:
                     sent = beam.partial_sent
@@ -3,15 +3,23 @@ all model
 '''
 import math
 from collections import namedtuple
+from functools import lru_cache
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions import Distribution
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from dataloader_clean import BOS_IDX, EOS_IDX, PAD_IDX, STEP_IDX
 
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
 EPSILON = 1e-7
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -19,6 +27,36 @@ class Identity(nn.Module):
     def forward(self, x):
         return x
 
+
+@torch.jit.script
+def out_tail(ctx: torch.Tensor,
+             w: torch.Tensor,
+             b: torch.Tensor,
+             normalize: bool = True) -> torch.Tensor:
+    '''
+    log_softmax(final_out(tanh(ctx))) as one scripted function, so that
+    tanh and log_softmax fuse with the linear;
+    with normalize=False the raw scores are returned
+    '''
+    ctx = F.linear(torch.tanh(ctx), w, b)
+    if normalize:
+        ctx = F.log_softmax(ctx, dim=-1)
+    return ctx
+
+
+@torch.jit.script
+def proj_tail(ctx: torch.Tensor,
+              w1: torch.Tensor,
+              b1: torch.Tensor,
+              w2: torch.Tensor,
+              b2: torch.Tensor,
+              normalize: bool = True) -> torch.Tensor:
+    '''
+    log_softmax(final_out(tanh(linear_out(ctx))))
+    '''
+    return out_tail(F.linear(ctx, w1, b1), w2, b2, normalize)
+
+
 class StackedLSTM(nn.Module):
     '''
     step-by-step stacked LSTM
@@ -31,41 +69,120 @@ class StackedLSTM(nn.Module):
         super().__init__()
         self.nb_layers = nb_layers
         self.rnn_siz = rnn_siz
-        self.layers = nn.ModuleList()
+        # one multi-layer LSTM, so cuDNN runs all layers in a single call
+        # per step; nn.LSTM only drops out between layers, the output of the
+        # last layer is dropped out in forward
+        self.lstm = nn.LSTM(input_siz,
+                            rnn_siz,
+                            nb_layers,
+                            dropout=dropout if nb_layers > 1 else 0)
         self.dropout = nn.Dropout(dropout)
 
-        for _ in range(nb_layers):
-            self.layers.append(nn.LSTMCell(input_siz, rnn_siz))
-            input_siz = rnn_siz
+    def __setstate__(self, state):
+        '''
+        turn the per-layer LSTMCell of old pickled models into self.lstm
+        '''
+        super().__setstate__(state)
+        if 'layers' not in self._modules:
+            return
+        layers = self._modules.pop('layers')
+        dropout = self.dropout.p if self.nb_layers > 1 else 0
+        lstm = nn.LSTM(layers[0].input_size,
+                       self.rnn_siz,
+                       self.nb_layers,
+                       dropout=dropout)
+        with torch.no_grad():
+            for i, layer in enumerate(layers):
+                for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+                    getattr(lstm, f'{name}_l{i}').copy_(getattr(layer, name))
+        self.lstm = lstm.to(layers[0].weight_ih.device).train(layers.training)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        '''
+        map checkpoints of the per-layer LSTMCell version onto self.lstm
+        '''
+        for i in range(self.nb_layers):
+            for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+                old_key = f'{prefix}layers.{i}.{name}'
+                if old_key in state_dict:
+                    new_key = f'{prefix}lstm.{name}_l{i}'
+                    state_dict[new_key] = state_dict.pop(old_key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def get_init_hx(self, batch_size):
         '''
         initial h0
         '''
-        h_0_s, c_0_s = [], []
-        for _ in range(self.nb_layers):
-            h_0 = torch.zeros((batch_size, self.rnn_siz), device=DEVICE)
-            c_0 = torch.zeros((batch_size, self.rnn_siz), device=DEVICE)
-            h_0_s.append(h_0)
-            c_0_s.append(c_0)
-        return (h_0_s, c_0_s)
+        h_0 = torch.zeros((self.nb_layers, batch_size, self.rnn_siz),
+                          device=DEVICE)
+        c_0 = torch.zeros((self.nb_layers, batch_size, self.rnn_siz),
+                          device=DEVICE)
+        return (h_0, c_0)
 
     def forward(self, input, hidden):
         '''
         dropout after all output except the last one
         '''
-        h_0, c_0 = hidden
-        h_1, c_1 = [], []
-        for i, layer in enumerate(self.layers):
-            h_1_i, c_1_i = layer(input, (h_0[i], c_0[i]))
-            input = self.dropout(h_1_i)
-            h_1 += [h_1_i]
-            c_1 += [c_1_i]
+        output, (h_1, c_1) = self.lstm(input.unsqueeze(0), hidden)
+        output = self.dropout(output.squeeze(0))
+        return output, (h_1, c_1)
+
+
+class SplitLinear(nn.Module):
+    '''
+    nn.Linear over cat((h expanded over seq_len, e), dim=-1), computed as
+    linear_h(h) + linear_e(e) so the concatenation is never materialized
+    '''
+
+    def __init__(self, h_dim, e_dim, out_dim):
+        '''
+        init
+        '''
+        super().__init__()
+        self.h_dim = h_dim
+        self.linear_h = nn.Linear(h_dim, out_dim)
+        self.linear_e = nn.Linear(e_dim, out_dim, bias=False)
+        # same init (and fan_in) as the single nn.Linear it replaces
+        self.copy_from(nn.Linear(h_dim + e_dim, out_dim))
+
+    @classmethod
+    def from_linear(cls, linear, h_dim):
+        '''
+        split an existing nn.Linear over cat((h, e), dim=-1)
+        '''
+        split = cls(h_dim, linear.in_features - h_dim, linear.out_features)
+        split.copy_from(linear)
+        return split.to(linear.weight.device).train(linear.training)
 
-        h_1 = torch.stack(h_1)
-        c_1 = torch.stack(c_1)
+    def copy_from(self, linear):
+        '''
+        load the weights of a single nn.Linear over cat((h, e), dim=-1)
+        '''
+        with torch.no_grad():
+            self.linear_h.weight.copy_(linear.weight[:, :self.h_dim])
+            self.linear_e.weight.copy_(linear.weight[:, self.h_dim:])
+            self.linear_h.bias.copy_(linear.bias)
 
-        return input, (h_1, c_1)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        '''
+        split checkpoints of the single concatenated nn.Linear
+        '''
+        weight_key, bias_key = f'{prefix}weight', f'{prefix}bias'
+        if weight_key in state_dict:
+            weight = state_dict.pop(weight_key)
+            state_dict[f'{prefix}linear_h.weight'] = weight[:, :self.h_dim]
+            state_dict[f'{prefix}linear_e.weight'] = weight[:, self.h_dim:]
+        if bias_key in state_dict:
+            state_dict[f'{prefix}linear_h.bias'] = state_dict.pop(bias_key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, h, e):
+        '''
+        h: batch x h_dim
+        e: batch x seq_len x e_dim
+        return: batch x seq_len x out_dim
+        '''
+        return self.linear_h(h).unsqueeze(1) + self.linear_e(e)
 
 
 class Attention(nn.Module):
@@ -73,40 +190,89 @@ class Attention(nn.Module):
     attention with mask
     '''
 
-    def forward(self, ht, hs, mask, weighted_ctx=True):
+    def forward(self,
+                ht,
+                hs,
+                mask,
+                weighted_ctx=True,
+                log_mask=None,
+                need_weights=True):
         '''
         ht: batch x ht_dim
-        hs: (seq_len x batch x hs_dim, seq_len x batch x ht_dim)
+        hs: (batch x seq_len x hs_dim, batch x seq_len x ht_dim)
         mask: seq_len x batch
+        log_mask: batch x seq_len, log(mask + EPSILON) if precomputed
+
+        with weighted_ctx and not need_weights, the weighted sum of hs comes
+        from the fused scaled_dot_product_attention kernel and no attention
+        weights are returned
         '''
         hs, hs_ = hs
-        # seq_len, batch, _ = hs.size()
-        hs = hs.transpose(0, 1)
-        hs_ = hs_.transpose(0, 1)
         # hs: batch x seq_len x hs_dim
         # hs_: batch x seq_len x ht_dim
-        # hs_ = self.hs2ht(hs)
-        # Alignment/Attention Function
-        # batch x ht_dim x 1
-        ht = ht.unsqueeze(2)
-        # batch x seq_len
-        score = torch.bmm(hs_, ht).squeeze(2)
-        # attn = F.softmax(score, dim=-1)
-        attn = F.softmax(score, dim=-1) * mask.transpose(0, 1) + EPSILON
-        attn = attn / attn.sum(-1, keepdim=True)
-
-        # Compute weighted sum of hs by attention.
+        if log_mask is None:
+            log_mask = torch.log(mask.transpose(0, 1) + EPSILON)
+        # batch x 1 x seq_len
+        log_mask = log_mask.unsqueeze(1)
+        # batch x 1 x ht_dim
+        ht = ht.unsqueeze(1)
+        if weighted_ctx and not need_weights:
+            # unscaled dot product with the additive log mask, same as
+            # softmax(score + log_mask) @ hs. batch x head x query x dim
+            # inputs with a single head, 3-d inputs only get the math kernel
+            weight_hs = F.scaled_dot_product_attention(
+                ht.unsqueeze(1),
+                hs_.unsqueeze(1),
+                hs.unsqueeze(1),
+                attn_mask=log_mask.unsqueeze(1),
+                scale=1.)
+            # batch x hs_dim
+            return weight_hs.view(weight_hs.size(0), -1), None
+
         # batch x 1 x seq_len
-        attn = attn.unsqueeze(1)
+        score = torch.bmm(ht, hs_.transpose(1, 2))
+        attn = F.softmax(score + log_mask, dim=-1)
         if weighted_ctx:
             # batch x hs_dim
             weight_hs = torch.bmm(attn, hs).squeeze(1)
         else:
             weight_hs = None
-
         return weight_hs, attn
 
 
+class StepOutput(object):
+    '''
+    collect per-step decoder outputs into a nb_step x ... tensor. stacked
+    when autograd is on, since writing into a buffer chains a CopySlices
+    per step; written into one preallocated buffer under no_grad.
+    '''
+
+    def __init__(self, nb_step):
+        self.nb_step = nb_step
+        self.steps = []
+        self.buffer = None
+        self.idx = 0
+
+    def append(self, step):
+        if torch.is_grad_enabled():
+            self.steps.append(step)
+            return
+        if self.buffer is None:
+            self.buffer = step.new_empty((self.nb_step, *step.shape))
+        self.buffer[self.idx] = step
+        self.idx += 1
+
+    def get(self):
+        if self.buffer is not None:
+            return self.buffer[:self.idx]
+        return torch.stack(self.steps)
+
+
+# batch-first encoder states, hs: batch x seq_len x src_hid_dim*2,
+# scale_hs: batch x seq_len x trg_hid_dim, log_mask: batch x seq_len
+EncState = namedtuple('EncState', 'hs scale_hs log_mask')
+
+
 class Transducer(nn.Module):
     '''
     seq2seq with soft attention baseline
@@ -147,66 +313,91 @@ class Transducer(nn.Module):
         self.final_out = nn.Linear(self.out_dim, trg_vocab_size)
         self.dropout = nn.Dropout(dropout_p)
 
-    def encode(self, src_batch):
+    def run_enc_rnn(self, src_embed, src_mask=None):
+        '''
+        run enc_rnn, skipping PAD positions of padded batches
+        '''
+        # a single sentence (as in decoding) has no padding, packing it
+        # would only add a host sync and a pack/unpack round trip
+        if src_mask is None or src_mask.size(1) == 1:
+            enc_hs, _ = self.enc_rnn(src_embed)
+            return enc_hs
+        lengths = src_mask.sum(0).long().cpu()
+        packed = pack_padded_sequence(src_embed, lengths, enforce_sorted=False)
+        enc_hs, _ = self.enc_rnn(packed)
+        enc_hs, _ = pad_packed_sequence(enc_hs, total_length=src_embed.size(0))
+        return enc_hs
+
+    def encode(self, src_batch, src_mask):
         '''
         encoder
         '''
-        enc_hs, _ = self.enc_rnn(self.dropout(self.src_embed(src_batch)))
-        scale_enc_hs = self.scale_enc_hs(enc_hs)
-        return enc_hs, scale_enc_hs
-
-    def decode_step(self, enc_hs, enc_mask, input_, hidden):
+        enc_hs = self.run_enc_rnn(self.dropout(self.src_embed(src_batch)),
+                                  src_mask)
+        # batch-first, transposed once here instead of every step
+        enc_hs = enc_hs.transpose(0, 1).contiguous()
+        # additive mask for log-space scores
+        log_mask = torch.log(src_mask.transpose(0, 1) + EPSILON)
+        return EncState(enc_hs, self.scale_enc_hs(enc_hs), log_mask)
+
+    def decode_step(self, enc_hs, enc_mask, input_, hidden, normalize=True):
         '''
-        decode step
+        decode step, return raw scores instead of log prob if not normalize
         '''
         h_t, hidden = self.dec_rnn(input_, hidden)
-        ctx, attn = self.attn(h_t, enc_hs, enc_mask)
+        # attention weights are only returned to the decoders, in eval mode
+        ctx, attn = self.attn(h_t, (enc_hs.hs, enc_hs.scale_hs),
+                              enc_mask,
+                              log_mask=enc_hs.log_mask,
+                              need_weights=not self.training)
         # Concatenate the ht and ctx
         # weight_hs: batch x (hs_dim + ht_dim)
         ctx = torch.cat((ctx, h_t), dim=1)
-        # ctx: batch x out_dim
-        ctx = self.linear_out(ctx)
-        ctx = torch.tanh(ctx)
-        word_logprob = F.log_softmax(self.final_out(ctx), dim=-1)
+        # word_logprob: batch x nb_vocab
+        word_logprob = proj_tail(ctx, self.linear_out.weight,
+                                 self.linear_out.bias, self.final_out.weight,
+                                 self.final_out.bias, normalize)
         return word_logprob, hidden, attn
 
     def decode(self, enc_hs, enc_mask, trg_batch):
         '''
-        enc_hs: tuple(enc_hs, scale_enc_hs)
+        enc_hs: EncState
+        return unnormalized scores, normalized by cross entropy in loss
         '''
         trg_seq_len = trg_batch.size(0)
         trg_bat_siz = trg_batch.size(1)
         trg_embed = self.dropout(self.trg_embed(trg_batch))
-        output = []
+        output = StepOutput(trg_seq_len - 1)
         hidden = self.dec_rnn.get_init_hx(trg_bat_siz)
         for idx in range(trg_seq_len - 1):
             input_ = trg_embed[idx, :]
-            word_logprob, hidden, _ = self.decode_step(enc_hs, enc_mask,
-                                                       input_, hidden)
-            output += [word_logprob]
-        return torch.stack(output)
+            word_logit, hidden, _ = self.decode_step(enc_hs,
+                                                     enc_mask,
+                                                     input_,
+                                                     hidden,
+                                                     normalize=False)
+            output.append(word_logit)
+        return output.get()
 
     def forward(self, src_batch, src_mask, trg_batch):
         '''
         only for training
         '''
         # trg_seq_len, batch_size = trg_batch.size()
-        enc_hs = self.encode(src_batch)
+        enc_hs = self.encode(src_batch, src_mask)
         # output: [trg_seq_len-1, batch_size, vocab_siz]
         output = self.decode(enc_hs, src_mask, trg_batch)
         return output
 
     def count_nb_params(self):
-        model_parameters = filter(lambda p: p.requires_grad, self.parameters())
-        params = sum([np.prod(p.size()) for p in model_parameters])
-        return params
+        return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
     def loss(self, predict, target):
         '''
-        compute loss
+        compute loss, predict is either raw scores or log prob
         '''
-        return F.nll_loss(
-            predict.view(-1, self.trg_vocab_size),
+        return F.cross_entropy(
+            predict.view(-1, self.trg_vocab_size).float(),
             target.view(-1),
             ignore_index=PAD_IDX)
 
@@ -220,6 +411,81 @@ class Transducer(nn.Module):
 HMMState = namedtuple('HMMState', 'init trans emiss')
 
 
+@torch.jit.script
+def hmm_forward(fwd: torch.Tensor, transition: torch.Tensor,
+                emiss: torch.Tensor) -> torch.Tensor:
+    '''
+    log-space forward induction
+    fwd: batch x 1 x nb_states
+    transition: seq_len-1 x batch x nb_states(to) x nb_states(from)
+    emiss: seq_len-1 x batch x 1 x nb_states
+    '''
+    for t in range(transition.size(0)):
+        # fwd[t + 1] = np.dot(fwd[t], a) * b[:, O[t + 1]]
+        fwd = (fwd + transition[t]).logsumexp(dim=-1, keepdim=True)
+        fwd = fwd.transpose(1, 2) + emiss[t]
+    return fwd
+
+
+# largest number of states the fused kernel keeps in registers
+TRITON_HMM_MAX_STATES = 64
+
+if triton is not None:
+
+    @triton.jit
+    def hmm_forward_kernel(fwd_ptr, trans_ptr, emiss_ptr, out_ptr, nb_step,
+                           bs, ns, BLOCK: tl.constexpr):
+        '''
+        whole forward induction of one batch element in one program,
+        fwd stays in registers across timesteps
+        '''
+        b = tl.program_id(0)
+        offs = tl.arange(0, BLOCK)
+        mask = offs < ns
+        mask_2d = mask[:, None] & mask[None, :]
+        fwd = tl.load(fwd_ptr + b * ns + offs, mask=mask, other=-float('inf'))
+        for t in range(nb_step):
+            step = t * bs + b
+            # trans[j, i]: log prob of moving from state i to state j
+            trans = tl.load(trans_ptr + step * ns * ns + offs[:, None] * ns +
+                            offs[None, :],
+                            mask=mask_2d,
+                            other=-float('inf'))
+            score = fwd[None, :] + trans
+            m = tl.max(score, axis=1)
+            lse = m + tl.log(tl.sum(tl.exp(score - m[:, None]), axis=1))
+            emiss = tl.load(emiss_ptr + step * ns + offs, mask=mask, other=0.)
+            fwd = tl.where(mask, lse + emiss, -float('inf'))
+        tl.store(out_ptr + b * ns + offs, fwd, mask=mask)
+
+
+def hmm_forward_triton(fwd, transition, emiss):
+    '''
+    same as hmm_forward, as a single fused kernel launch. there is no
+    backward, so training still runs hmm_forward: this only speeds up the
+    dev loss, computed under no_grad
+    '''
+    nb_step, bs, ns, _ = transition.shape
+    out = torch.empty_like(fwd)
+    hmm_forward_kernel[(bs, )](fwd.contiguous(), transition.contiguous(),
+                               emiss.contiguous(), out, nb_step, bs, ns,
+                               BLOCK=triton.next_power_of_2(ns))
+    return out
+
+
+def use_triton_hmm(*tensors):
+    '''
+    the fused kernel is forward only: use it for cuda inputs outside of
+    autograd, with few enough states to fit in registers
+    '''
+    if triton is None or not tensors[0].is_cuda:
+        return False
+    if tensors[0].shape[-1] > TRITON_HMM_MAX_STATES:
+        return False
+    grad = torch.is_grad_enabled() and any(t.requires_grad for t in tensors)
+    return not grad
+
+
 class HMM(object):
     def __init__(self, nb_states, nb_tokens, initial, transition, emission):
         assert isinstance(initial, torch.Tensor)
@@ -230,20 +496,26 @@ class HMM(object):
         assert emission.shape[-2:] == (nb_states, nb_tokens)
         self.ns = nb_states
         self.V = nb_tokens
-        self.initial = initial
-        self.transition = transition
-        self.emission = emission
-
-    def emiss(self, T, idx, ignore_index=None):
-        assert len(idx.shape) == 1
-        bs = idx.shape[0]
-        idx = idx.view(-1, 1).expand(bs, self.ns).unsqueeze(-1)
-        emiss = torch.gather(self.emission[T], -1, idx).view(bs, 1, self.ns)
+        # the forward recursion accumulates logsumexp over the whole
+        # sequence, keep it in fp32 even when the decoder ran under autocast
+        self.initial = initial.float()
+        self.transition = transition.float()
+        self.emission = emission.float()
+
+    def emiss(self, seq, ignore_index=None):
+        '''
+        emission log prob of seq under every state, gathered for all
+        timesteps at once
+        seq: seq_len x batch
+        return: seq_len x batch x 1 x nb_states
+        '''
+        T, bs = seq.shape
+        idx = seq.view(T, bs, 1, 1).expand(T, bs, self.ns, 1)
+        emiss = torch.gather(self.emission, -1, idx).view(T, bs, 1, self.ns)
         if ignore_index is None:
             return emiss
         else:
-            idx = idx.view(bs, 1, self.ns)
-            mask = (idx != ignore_index).float()
+            mask = (seq != ignore_index).float().view(T, bs, 1, 1)
             return emiss * mask
 
     def p_x(self, seq, ignore_index=None):
@@ -251,22 +523,38 @@ class HMM(object):
         assert self.initial.shape == (bs, 1, self.ns)
         assert self.transition.shape == (T - 1, bs, self.ns, self.ns)
         assert self.emission.shape == (T, bs, self.ns, self.V)
+        emiss = self.emiss(seq, ignore_index=ignore_index)
         # fwd = pi * b[:, O[0]]
-        # fwd = self.initial * self.emiss(0, seq[0])
-        fwd = self.initial + self.emiss(0, seq[0], ignore_index=ignore_index)
-        #induction:
-        for t in range(T - 1):
-            # fwd[t + 1] = np.dot(fwd[t], a) * b[:, O[t + 1]]
-            # fwd = torch.bmm(fwd, self.transition[t]) * self.emiss(
-            #     t + 1, seq[t + 1])
-            fwd = fwd + self.transition[t].transpose(1, 2)
-            fwd = fwd.logsumexp(dim=-1, keepdim=True).transpose(1, 2)
-            fwd = fwd + self.emiss(
-                t + 1, seq[t + 1], ignore_index=ignore_index)
-        return fwd
-
-
-class HMMTransducer(Transducer):
+        fwd = self.initial + emiss[0]
+        # transposed once for all timesteps instead of once per step
+        transition = self.transition.transpose(-1, -2).contiguous()
+        if use_triton_hmm(fwd, transition, emiss):
+            return hmm_forward_triton(fwd, transition, emiss[1:])
+        return hmm_forward(fwd, transition, emiss[1:])
+
+
+class SplitOutTransducer(Transducer):
+    '''
+    transducer with linear_out over cat((ht, hs)) at every source position,
+    as a SplitLinear
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.linear_out = SplitLinear(self.trg_hid_size,
+                                      self.src_hid_size * 2, self.out_dim)
+
+    def __setstate__(self, state):
+        '''
+        models pickled before SplitLinear hold a single nn.Linear linear_out
+        '''
+        super().__setstate__(state)
+        if isinstance(self._modules.get('linear_out'), nn.Linear):
+            self.linear_out = SplitLinear.from_linear(self.linear_out,
+                                                      self.trg_hid_size)
+
+
+class HMMTransducer(SplitOutTransducer):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         del self.attn
@@ -277,7 +565,7 @@ class HMMTransducer(Transducer):
         hmm = HMM(predict.init.shape[-1], self.trg_vocab_size, predict.init,
                   predict.trans, predict.emiss)
         loss = hmm.p_x(target, ignore_index=PAD_IDX)
-        return -torch.logsumexp(loss, dim=-1).mean() / seq_len
+        return -torch.logsumexp(loss.float(), dim=-1).mean() / seq_len
 
     def decode(self, enc_hs, enc_mask, trg_batch):
         trg_seq_len = trg_batch.size(0)
@@ -285,54 +573,55 @@ class HMMTransducer(Transducer):
         trg_embed = self.dropout(self.trg_embed(trg_batch))
         hidden = self.dec_rnn.get_init_hx(trg_bat_siz)
 
-        initial, transition, emission = None, list(), list()
+        initial = None
+        transition = StepOutput(trg_seq_len - 2)
+        emission = StepOutput(trg_seq_len - 1)
         for idx in range(trg_seq_len - 1):
             input_ = trg_embed[idx, :]
             trans, emiss, hidden = self.decode_step(enc_hs, enc_mask, input_,
                                                     hidden)
             if idx == 0:
                 initial = trans[:, 0].unsqueeze(1)
-                emission += [emiss]
             else:
-                transition += [trans]
-                emission += [emiss]
-        transition = torch.stack(transition)
-        emission = torch.stack(emission)
-        return HMMState(initial, transition, emission)
+                transition.append(trans)
+            emission.append(emiss)
+        return HMMState(initial, transition.get(), emission.get())
 
     def decode_step(self, enc_hs, enc_mask, input_, hidden):
         src_seq_len, bat_siz = enc_mask.shape
         h_t, hidden = self.dec_rnn(input_, hidden)
 
-        # Concatenate the ht and hs
-        # ctx_*: batch x seq_len x (trg_hid_siz+src_hid_size*2)
-        ctx_curr = torch.cat(
-            (h_t.unsqueeze(1).expand(-1, src_seq_len, -1), enc_hs[0].transpose(
-                0, 1)),
-            dim=2)
+        # linear_out over the concatenated ht and hs
+        # ctx: batch x seq_len x out_dim
+        ctx = self.linear_out(h_t, enc_hs.hs)
 
-        hs_ = enc_hs[1].transpose(0, 1)
         h_t = h_t.unsqueeze(2)
-        score = torch.bmm(hs_, h_t).squeeze(2)
-        trans = F.softmax(score, dim=-1) * enc_mask.transpose(0, 1) + EPSILON
-        trans = trans / trans.sum(-1, keepdim=True)
-        trans = trans.unsqueeze(1).log()
+        score = torch.bmm(enc_hs.scale_hs, h_t).squeeze(2)
+        # masked softmax directly in log space
+        trans = F.log_softmax(score + enc_hs.log_mask, dim=-1).unsqueeze(1)
         trans = trans.expand(bat_siz, src_seq_len, src_seq_len)
 
-        ctx = torch.tanh(self.linear_out(ctx_curr))
         # emiss: batch x seq_len x nb_vocab
-        emiss = F.log_softmax(self.final_out(ctx), dim=-1)
+        emiss = out_tail(ctx, self.final_out.weight, self.final_out.bias)
 
         return trans, emiss, hidden
 
 
+@lru_cache(maxsize=None)
+def mono_trans_mask(seq_len, device):
+    '''
+    log-space mask forbidding backward transitions, built once per source
+    length: 0 on and above the diagonal, log(EPSILON) below
+    '''
+    trans_mask = torch.ones((seq_len, seq_len), device=device).triu()
+    return ((trans_mask - 1) * -np.log(EPSILON)).unsqueeze(0)
+
+
 class MonoHMMTransducer(HMMTransducer):
     def decode_step(self, enc_hs, enc_mask, input_, hidden):
         trans, emiss, hidden = super().decode_step(enc_hs, enc_mask, input_,
                                                    hidden)
-        trans_mask = torch.ones_like(trans[0]).triu().unsqueeze(0)
-        trans_mask = (trans_mask - 1) * -np.log(EPSILON)
-        trans = trans + trans_mask
+        trans = trans + mono_trans_mask(trans.shape[-1], trans.device)
         trans = trans - trans.logsumexp(-1, keepdim=True)
         return trans, emiss, hidden
 
@@ -377,7 +666,7 @@ class HardMonoTransducer(Transducer):
             c /= (layer * 2 - 1)
         return round((math.sqrt(b * b - 4 * c) - b) / 2)
 
-    def encode(self, src_batch):
+    def encode(self, src_batch, src_mask=None):
         '''
         encoder
         '''
@@ -385,17 +674,25 @@ class HardMonoTransducer(Transducer):
             assert isinstance(src_batch, tuple) and len(src_batch) == 2
             src, attr = src_batch
             bs = src.shape[1]
-            enc_hs, _ = self.enc_rnn(self.dropout(self.src_embed(src)))
+            enc_hs = self.run_enc_rnn(self.dropout(self.src_embed(src)),
+                                      src_mask)
             enc_attr = F.relu(
                 self.merge_attr(self.src_embed(attr).view(bs, -1)))
             return enc_hs, enc_attr
         else:
-            enc_hs, _ = self.enc_rnn(self.dropout(self.src_embed(src_batch)))
+            enc_hs = self.run_enc_rnn(self.dropout(self.src_embed(src_batch)),
+                                      src_mask)
             return enc_hs, None
 
-    def decode_step(self, enc_hs, enc_mask, input_, hidden, attn_pos):
+    def decode_step(self,
+                    enc_hs,
+                    enc_mask,
+                    input_,
+                    hidden,
+                    attn_pos,
+                    normalize=True):
         '''
-        decode step
+        decode step, return raw scores instead of log prob if not normalize
         '''
         source, attr = enc_hs
         bs = source.shape[1]
@@ -409,7 +706,9 @@ class HardMonoTransducer(Transducer):
         else:
             input_ = torch.cat((input_, attr, ctx), dim=1)
         h_t, hidden = self.dec_rnn(input_, hidden)
-        word_logprob = F.log_softmax(self.final_out(h_t), dim=-1)
+        word_logprob = self.final_out(h_t)
+        if normalize:
+            word_logprob = F.log_softmax(word_logprob, dim=-1)
         return word_logprob, hidden, None
 
     def decode(self, enc_hs, enc_mask, trg_batch):
@@ -418,43 +717,43 @@ class HardMonoTransducer(Transducer):
         '''
         trg_seq_len = trg_batch.size(0)
         trg_bat_siz = trg_batch.size(1)
-        attn_pos = torch.zeros((1, trg_bat_siz),
-                               dtype=torch.long,
-                               device=DEVICE)
         trg_embed = self.dropout(self.trg_embed(trg_batch))
-        output = []
+        # attn_pos at step idx: number of STEP in trg_batch[:idx + 1]
+        steps = (trg_batch == STEP_IDX).long().cumsum(dim=0)
+        output = StepOutput(trg_seq_len - 1)
         hidden = self.dec_rnn.get_init_hx(trg_bat_siz)
         for idx in range(trg_seq_len - 1):
-            for j in range(trg_bat_siz):
-                if trg_batch[idx, j] == STEP_IDX:
-                    attn_pos[0, j] += 1
+            attn_pos = steps[idx:idx + 1]
             input_ = trg_embed[idx, :]
-            word_logprob, hidden, _ = self.decode_step(
-                enc_hs, enc_mask, input_, hidden, attn_pos)
-            output += [word_logprob]
-        return torch.stack(output)
-
-class HardAttnTransducer(Transducer):
-    def decode_step(self, enc_hs, enc_mask, input_, hidden):
+            word_logit, hidden, _ = self.decode_step(enc_hs,
+                                                     enc_mask,
+                                                     input_,
+                                                     hidden,
+                                                     attn_pos,
+                                                     normalize=False)
+            output.append(word_logit)
+        return output.get()
+
+
+class HardAttnTransducer(SplitOutTransducer):
+    def decode_step(self, enc_hs, enc_mask, input_, hidden, normalize=True):
         '''
-        enc_hs: tuple(enc_hs, scale_enc_hs)
+        enc_hs: EncState
+        the mixture is always a log prob, normalize is only for compatibility
         '''
-        src_seq_len = enc_hs[0].size(0)
         h_t, hidden = self.dec_rnn(input_, hidden)
 
         # ht: batch x trg_hid_dim
-        # enc_hs: seq_len x batch x src_hid_dim*2
+        # enc_hs.hs: batch x seq_len x src_hid_dim*2
         # attns: batch x 1 x seq_len
-        _, attns = self.attn(h_t, enc_hs, enc_mask, weighted_ctx=False)
-
-        # Concatenate the ht and hs
-        # ctx: batch x seq_len x (trg_hid_siz+src_hid_size*2)
-        ctx = torch.cat(
-            (h_t.unsqueeze(1).expand(-1, src_seq_len, -1), enc_hs[0].transpose(
-                0, 1)),
-            dim=2)
+        _, attns = self.attn(h_t, (enc_hs.hs, enc_hs.scale_hs),
+                             enc_mask,
+                             weighted_ctx=False,
+                             log_mask=enc_hs.log_mask)
+
+        # linear_out over the concatenated ht and hs
         # ctx: batch x seq_len x out_dim
-        ctx = self.linear_out(ctx)
+        ctx = self.linear_out(h_t, enc_hs.hs)
         ctx = torch.tanh(ctx)
 
         # word_prob: batch x seq_len x nb_vocab
@@ -465,9 +764,15 @@ class HardAttnTransducer(Transducer):
 
 
 def fancy_gather(value, index):
+    '''
+    out[k, j] = value[index[k, j], j]
+    value: seq_len x batch (x hid_dim)
+    index: n x batch
+    '''
     assert value.size(1) == index.size(1)
-    split = zip(value.split(1, dim=1), index.split(1, dim=1))
-    return torch.cat([v[i.view(-1)] for v, i in split], dim=1)
+    if value.dim() == 3:
+        index = index.unsqueeze(-1).expand(-1, -1, value.size(-1))
+    return value.gather(0, index)
 
 
 class Categorical(Distribution):
@@ -475,13 +780,15 @@ class Categorical(Distribution):
         assert probs.dim() == 2
         self.nb_prob, self.nb_choice = probs.size()
         self.probs = probs
-        self.probs_t = probs.t()
 
     def sample_n(self, n):
         return torch.multinomial(self.probs, n, True).t()
 
     def log_prob(self, value):
-        return (fancy_gather(self.probs_t, value) + EPSILON).log()
+        '''
+        value: n x nb_prob, as returned by sample_n
+        '''
+        return (self.probs.gather(1, value.t()).t() + EPSILON).log()
 
 def dummy_mask(seq):
     '''
@@ -490,4 +797,5 @@ def dummy_mask(seq):
     if isinstance(seq, tuple):
         seq = seq[0]
     assert len(seq.size()) == 1 or (len(seq.size()) == 2 and seq.size(1) == 1)
-    return torch.ones_like(seq, dtype=torch.float)
+    # broadcast view of a single 1, the mask is only read
+    return torch.ones((), device=seq.device).expand_as(seq)
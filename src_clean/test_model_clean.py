@@ -0,0 +1,28 @@
+'''
+tests for model_clean, run with pytest from src_clean
+'''
+import pytest
+import torch
+
+from model_clean import (TRITON_HMM_MAX_STATES, hmm_forward,
+                         hmm_forward_triton, triton)
+
+
+@pytest.mark.skipif(triton is None or not torch.cuda.is_available(),
+                    reason='needs cuda and triton')
+@pytest.mark.parametrize('ns', [1, 7, TRITON_HMM_MAX_STATES])
+@pytest.mark.parametrize('T', [1, 2, 30])
+def test_hmm_forward_triton(ns, T):
+    '''
+    the fused kernel matches hmm_forward on random inputs
+    '''
+    bs, device = 3, torch.device('cuda')
+    gen = torch.Generator(device=device).manual_seed(0)
+    fwd = torch.randn((bs, 1, ns), device=device, generator=gen)
+    trans = torch.randn((T - 1, bs, ns, ns), device=device,
+                        generator=gen).log_softmax(-1)
+    emiss = torch.randn((T - 1, bs, 1, ns), device=device, generator=gen)
+    with torch.no_grad():
+        expect = hmm_forward(fwd, trans, emiss)
+        actual = hmm_forward_triton(fwd, trans, emiss)
+    assert torch.allclose(actual, expect, rtol=1e-4, atol=1e-4)
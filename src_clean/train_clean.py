@@ -134,7 +134,7 @@ class Trainer(BaseTrainer):
         self.model = model_class(**kwargs)
         if params.indtag:
             self.logger.info('number of attribute %d', self.model.nb_attr)
-            self.logger.info('dec 1st rnn %r', self.model.dec_rnn.layers[0])
+            self.logger.info('dec rnn %r', self.model.dec_rnn.lstm)
         self.logger.info('model: %r', self.model)
         self.logger.info('number of parameter %d',
                          self.model.count_nb_params())
@@ -245,7 +245,9 @@ def main():
     else:  # start from scratch
         start_epoch = 0
         trainer.build_model()
-        if params.init:
+        # under torchrun only rank 0 touches --init, DDP copies its
+        # parameters to the other ranks in setup_training
+        if params.init and trainer.is_main:
             if os.path.isfile(params.init):
                 trainer.load_state_dict(params.init)
             else:
@@ -4,12 +4,17 @@ import os
 import random
 import re
 from dataclasses import dataclass
+from datetime import timedelta
 from functools import partial
+from itertools import islice
 from math import ceil
 from typing import List, Optional
 
 import numpy as np
 import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from tqdm import tqdm
 
@@ -44,6 +49,20 @@ def setup_seed(seed):
         torch.cuda.manual_seed_all(seed)
 
 
+def wrap_around(batches, nb_batch, total):
+    '''
+    yield the nb_batch batches, then start over from the first ones until
+    total batches are yielded. only the batches needed again are kept
+    '''
+    head = []
+    for batch in batches:
+        if len(head) < total - nb_batch:
+            head.append(batch)
+        yield batch
+    for idx in range(total - nb_batch):
+        yield head[idx % len(head)]
+
+
 @dataclass
 class Evaluation:
     filepath: str
@@ -51,6 +70,19 @@ class Evaluation:
     evaluation_result: Optional[List[util.Eval]]
 
 
+class GetLoss(nn.Module):
+    '''
+    route model.get_loss through forward, so that DistributedDataParallel
+    sees the training step and all-reduces the gradients
+    '''
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, batch):
+        return self.model.get_loss(batch)
+
+
 class BaseTrainer(object):
     '''docstring for Trainer.'''
     def __init__(self):
@@ -59,17 +91,35 @@ class BaseTrainer(object):
         self.set_args()
         self.params = self.get_params()
 
+        # launched by torchrun with more than one process: one GPU each
+        self.world_size = int(os.environ.get('WORLD_SIZE', 1))
+        self.distributed = self.world_size > 1
+        self.rank = int(os.environ.get('RANK', 0))
+        self.is_main = self.rank == 0
+        if self.distributed:
+            torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
+            # the other ranks wait in a collective while rank 0 decodes dev
+            timeout = timedelta(seconds=self.params.dist_timeout)
+            dist.init_process_group(backend='nccl', timeout=timeout)
+
         util.maybe_mkdir(self.params.model)
-        self.logger = util.get_logger(self.params.model + '.log',
+        log_file = self.params.model + '.log'
+        if not self.is_main:
+            log_file = f'{self.params.model}.rank{self.rank}.log'
+        self.logger = util.get_logger(log_file,
                                       log_level=self.params.loglevel)
         for key, value in vars(self.params).items():
             self.logger.info('command line argument: %s - %r', key, value)
         setup_seed(self.params.seed)
 
         self.data = None
-        self.device = torch.device(
-            "cuda" if torch.cuda.is_available() else "cpu")
+        if self.distributed:
+            self.device = torch.device('cuda', torch.cuda.current_device())
+        else:
+            self.device = torch.device(
+                "cuda" if torch.cuda.is_available() else "cpu")
         self.model = None
+        self.ddp_model = None
         self.optimizer = None
         self.min_lr = 0
         self.scheduler = None
@@ -107,6 +157,8 @@ class BaseTrainer(object):
         parser.add_argument('--patience', default=0, type=int, help='patience of `ReduceLROnPlateau`')
         parser.add_argument('--discount_factor', default=0.5, type=float, help='discount factor of `ReduceLROnPlateau`')
         parser.add_argument('--max_norm', default=0, type=float, help='gradient clipping max norm')
+        parser.add_argument('--bf16', default=False, action='store_true', help='run the training forward pass under bf16 autocast')
+        parser.add_argument('--dist_timeout', default=7200, type=int, help='timeout (in seconds) of collectives under torchrun, must cover decoding dev on rank 0')
         parser.add_argument('--gpuid', default=[], nargs='+', type=int, help='choose which GPU to use')
         parser.add_argument('--loglevel', default='info', choices=['info', 'debug'])
         parser.add_argument('--saveall', default=False, action='store_true', help='keep all models')
@@ -159,6 +211,9 @@ class BaseTrainer(object):
     def setup_training(self):
         assert self.model is not None
         params = self.params
+        if self.distributed:
+            self.ddp_model = DistributedDataParallel(
+                GetLoss(self.model), device_ids=[self.device.index])
         if params.optimizer == Optimizer.sgd:
             self.optimizer = torch.optim.SGD(self.model.parameters(),
                                              params.lr,
@@ -224,9 +279,27 @@ class BaseTrainer(object):
         logger.info('At %d-th epoch with lr %f.', epoch_idx, self.get_lr())
         model.train()
         sampler, nb_batch = self.iterate_batch(TRAIN, batch_size)
+        batches = sampler(batch_size)
+        if self.distributed:
+            # every rank sees the same batch order (same seed) and takes its
+            # own slice of it, with the same number of steps on every rank.
+            # rounded up like DistributedSampler without drop_last, the last
+            # ranks wrap around to the first batches
+            per_rank = ceil(nb_batch / self.world_size)
+            batches = wrap_around(batches, nb_batch,
+                                  per_rank * self.world_size)
+            batches = islice(batches, self.rank, None, self.world_size)
+            nb_batch = per_rank
         losses, cnt = 0, 0
-        for batch in tqdm(sampler(batch_size), total=nb_batch):
-            loss = model.get_loss(batch)
+        for batch in tqdm(batches, total=nb_batch):
+            # bf16 keeps the fp32 exponent range, so no GradScaler is needed
+            with torch.autocast(device_type=self.device.type,
+                                dtype=torch.bfloat16,
+                                enabled=self.params.bf16):
+                if self.distributed:
+                    loss = self.ddp_model(batch)
+                else:
+                    loss = model.get_loss(batch)
             self.optimizer.zero_grad()
             loss.backward()
             if max_norm > 0:
@@ -351,6 +424,8 @@ class BaseTrainer(object):
         finish = False
         params = self.params
         steps_per_epoch = ceil(self.data.nb_train / params.bs)
+        if self.distributed:
+            steps_per_epoch = ceil(steps_per_epoch / self.world_size)
         if params.max_steps > 0:
             max_epochs = ceil(params.max_steps / steps_per_epoch)
         else:
@@ -369,13 +444,27 @@ class BaseTrainer(object):
                                    or epoch_idx + 1 == max_epochs)):
                 continue
             with torch.no_grad():
+                # all ranks compute the dev loss to keep the data shuffling
+                # in step, only the main process decodes and saves
                 devloss = self.calc_loss(DEV, params.bs, epoch_idx)
-                eval_res = self.evaluate(DEV, epoch_idx, decode_fn)
+                if self.is_main:
+                    eval_res = self.evaluate(DEV, epoch_idx, decode_fn)
+            if self.distributed:
+                # schedule and early stopping follow the main process
+                devloss = [devloss]
+                dist.broadcast_object_list(devloss, src=0)
+                devloss = devloss[0]
             if self.update_lr_and_stop_early(epoch_idx, devloss, params.estop):
                 finish = True
                 break
-            self.save_model(epoch_idx, devloss, eval_res, params.model)
-            self.save_training(params.model)
+            if self.is_main:
+                self.save_model(epoch_idx, devloss, eval_res, params.model)
+                self.save_training(params.model)
+        if self.distributed:
+            # no collectives past this point, the final test is main only
+            dist.destroy_process_group()
+        if not self.is_main:
+            return
         if finish or params.cleanup_anyway:
             best_fp, save_fps = self.select_model()
             with torch.no_grad():
@@ -2,7 +2,6 @@ import copy
 import math
 from collections import namedtuple
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -302,9 +301,7 @@ class Transformer(nn.Module):
         return output
 
     def count_nb_params(self):
-        model_parameters = filter(lambda p: p.requires_grad, self.parameters())
-        params = sum([np.prod(p.size()) for p in model_parameters])
-        return params
+        return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
     def loss(self, predict, target):
         '''